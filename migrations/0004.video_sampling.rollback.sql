@@ -0,0 +1,3 @@
+ALTER TABLE "video"
+    DROP COLUMN "num_samples",
+    DROP COLUMN "sampled_duration";
@@ -0,0 +1,3 @@
+ALTER TABLE "video"
+    ADD COLUMN "num_samples" int4,
+    ADD COLUMN "sampled_duration" real;
@@ -1,16 +1,32 @@
 import contextlib
 import enum
 import os
-import pathlib
+import time
 from datetime import datetime, timezone
 
 import asyncpg
 import fastapi
 
+import imagestore
+
 
 DSN = os.environ["DSN"]
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 5))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 50))
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app_):
+    app_.state.db_pool = await asyncpg.create_pool(DSN, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, command_timeout=60)
+    try:
+        yield
+    finally:
+        await app_.state.db_pool.close()
+
 
-app = fastapi.FastAPI()
+app = fastapi.FastAPI(lifespan=lifespan)
+db_pool_metrics = {"acquired": 0, "waiting": 0, "waiting_max": 0, "wait_seconds": 0.0, "wait_seconds_max": 0.0}
+image_store = imagestore.PackReader()
 
 
 class Emotion(enum.Enum):
@@ -29,34 +45,66 @@ async def index():
 
 
 @app.get("/images/{channel_id}/{emotion}.jpg")
-async def images(channel_id: str, emotion: Emotion):
-    filepath = pathlib.Path(__file__).parent / "images" / channel_id / (emotion.value + ".jpg")
-    if filepath.exists():
-        return fastapi.responses.FileResponse(filepath)
-    else:
+async def images(channel_id: str, emotion: Emotion, if_none_match: str | None = fastapi.Header(None)):
+    image = image_store.get(imagestore.key(channel_id, emotion.value))
+    if image is None:
         return fastapi.responses.Response(status_code=404)
+    data, crc = image
+    headers = {"ETag": f'"{crc:08x}"', "Cache-Control": "max-age=3600"}
+    if if_none_match == headers["ETag"]:
+        return fastapi.responses.Response(status_code=304, headers=headers)
+    return fastapi.responses.Response(data, media_type="image/jpeg", headers=headers)
 
 
 @app.get("/api")
 async def api(order_by: Emotion = Emotion.happy, asc: bool = False):
-    async with get_db_pool() as db_pool:
-        asc_or_desc = "ASC" if asc else "DESC"
-        query = f"""
-            SELECT "id", "title", "angry", "happy", "sad", "surprise", "fear", "disgust", "neutral", "contempt"
-            FROM "channel"
-            WHERE "angry" IS NOT NULL AND "happy" IS NOT NULL AND "sad" IS NOT NULL AND "surprise" IS NOT NULL
-            AND "fear" IS NOT NULL AND "disgust" IS NOT NULL AND "neutral" IS NOT NULL AND "contempt" IS NOT NULL
-            ORDER BY "{order_by.value}" {asc_or_desc}
-        """
-        rows = await db_pool.fetch(query)
+    async with get_db_connection() as db_connection:
+        rows = await db_connection.fetch(api_query(order_by, asc))
     return [dict(r) for r in rows]
 
 
+@app.get("/metrics")
+async def metrics():
+    db_pool = app.state.db_pool
+    return {
+        "db_pool": {
+            **db_pool_metrics,
+            "size": db_pool.get_size(),
+            "idle": db_pool.get_idle_size(),
+            "min_size": db_pool.get_min_size(),
+            "max_size": db_pool.get_max_size(),
+        },
+    }
+
+
+def api_query(order_by, asc):
+    asc_or_desc = "ASC" if asc else "DESC"
+    return f"""
+        SELECT "id", "title", "angry", "happy", "sad", "surprise", "fear", "disgust", "neutral", "contempt"
+        FROM "channel"
+        WHERE "angry" IS NOT NULL AND "happy" IS NOT NULL AND "sad" IS NOT NULL AND "surprise" IS NOT NULL
+        AND "fear" IS NOT NULL AND "disgust" IS NOT NULL AND "neutral" IS NOT NULL AND "contempt" IS NOT NULL
+        ORDER BY "{order_by.value}" {asc_or_desc}
+    """
+
+
 @contextlib.asynccontextmanager
-async def get_db_pool():
-    if not hasattr(get_db_pool, "pool"):
-        get_db_pool.pool = await asyncpg.create_pool(DSN, min_size=1, max_size=50, command_timeout=60)
-    yield get_db_pool.pool
+async def get_db_connection():
+    db_pool_metrics["waiting"] += 1
+    db_pool_metrics["waiting_max"] = max(db_pool_metrics["waiting_max"], db_pool_metrics["waiting"])
+    started = time.monotonic()
+    try:
+        db_connection = await app.state.db_pool.acquire()
+    finally:
+        db_pool_metrics["waiting"] -= 1
+    wait_seconds = time.monotonic() - started
+    db_pool_metrics["acquired"] += 1
+    db_pool_metrics["wait_seconds"] += wait_seconds
+    db_pool_metrics["wait_seconds_max"] = max(db_pool_metrics["wait_seconds_max"], wait_seconds)
+    try:
+        yield db_connection
+    finally:
+        await app.state.db_pool.release(db_connection)
 
 
 def now():
@@ -0,0 +1,186 @@
+import argparse
+import inspect
+import json
+import logging
+import math
+import statistics
+import time
+
+import psycopg2
+
+import asgi
+import db
+import logging_config
+import main as backend
+import scheduler
+import utils
+
+
+logger = logging.getLogger("youmood")
+
+CHUNK_SIZE = 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fill a scratch database with synthetic data and benchmark the queries")
+    parser.add_argument("--channels", type=int, default=100_000)
+    parser.add_argument("--videos", type=int, default=10_000_000)
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="previous JSON output to compare latencies with")
+    parser.add_argument("--skip-fill", action="store_true", help="reuse synthetic data from the previous run")
+    args = parser.parse_args()
+
+    backend.migrate()
+    connection = psycopg2.connect(db.DSN)
+    connection.autocommit = True
+    if not args.skip_fill:
+        fill(connection, args.channels, args.videos)
+    results = {
+        "channels": args.channels,
+        "videos": args.videos,
+        "repeat": args.repeat,
+        "queries": {name: measure(connection, statements, args.repeat) for name, statements in capture(connection)},
+    }
+    connection.close()
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2, default=str)
+    logger.info("saved results to %s", args.output)
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(json.load(file), results)
+
+
+def fill(connection, num_channels, num_videos):
+    with connection.cursor() as cursor:
+        cursor.execute("""DELETE FROM "video" WHERE "id" LIKE 'synthetic-%'""")
+        cursor.execute("""DELETE FROM "channel" WHERE "id" LIKE 'synthetic-%'""")
+        cursor.execute(
+            """
+            INSERT INTO "channel" (
+                "id", "added", "title", "num_subscribers", "synchronized",
+                "angry", "happy", "sad", "surprise", "fear", "disgust", "neutral", "contempt"
+            )
+            SELECT
+                'synthetic-' || i, now() - interval '90 days', 'synthetic channel ' || i, (random() * 1e7)::int8,
+                CASE WHEN random() < 0.05 THEN NULL ELSE now() - random() * interval '3 days' END,
+                random() * 0.1, random() * 0.3, random() * 0.1, random() * 0.1,
+                random() * 0.05, random() * 0.05, random() * 0.5, random() * 0.05
+            FROM generate_series(1, %s) AS i
+            """,
+            (num_channels,),
+        )
+        logger.info("inserted %s channels", num_channels)
+        for start in range(0, num_videos, CHUNK_SIZE):
+            cursor.execute(
+                """
+                INSERT INTO "video" (
+                    "id", "channel_id", "found", "published", "title", "stage", "fps", "num_frames",
+                    "angry", "happy", "sad", "surprise", "fear", "disgust", "neutral", "contempt"
+                )
+                SELECT
+                    'synthetic-' || i, 'synthetic-' || (1 + floor(%s * power(random(), 3)))::int8,
+                    "published" + random() * interval '2 days', "published", 'synthetic video ' || i,
+                    "stage", 30, CASE WHEN "stage" = 3 THEN "duration" * 30 END,
+                    CASE WHEN "stage" = 3 THEN ("duration" * random() * 0.1)::int8 END,
+                    CASE WHEN "stage" = 3 THEN ("duration" * random() * 0.3)::int8 END,
+                    CASE WHEN "stage" = 3 THEN ("duration" * random() * 0.1)::int8 END,
+                    CASE WHEN "stage" = 3 THEN ("duration" * random() * 0.1)::int8 END,
+                    CASE WHEN "stage" = 3 THEN ("duration" * random() * 0.05)::int8 END,
+                    CASE WHEN "stage" = 3 THEN ("duration" * random() * 0.05)::int8 END,
+                    CASE WHEN "stage" = 3 THEN ("duration" * random() * 0.5)::int8 END,
+                    CASE WHEN "stage" = 3 THEN ("duration" * random() * 0.05)::int8 END
+                FROM (
+                    SELECT
+                        i,
+                        now() - power(random(), 2) * interval '365 days' AS "published",
+                        (60 + power(random(), 2) * 7200)::int4 AS "duration",
+                        (ARRAY[0, 0, 0, 0, 0, 0, 0, 3, 3, -1, -2, 1])[1 + floor(random() * 12)::int]::int2 AS "stage"
+                    FROM generate_series(%s, %s) AS i
+                ) AS "synthetic"
+                """,
+                (num_channels - 1, start + 1, min(start + CHUNK_SIZE, num_videos)),
+            )
+            logger.info("inserted %s of %s videos", min(start + CHUNK_SIZE, num_videos), num_videos)
+        cursor.execute('VACUUM ANALYZE "channel", "video"')
+
+
+def capture(connection):
+    recorder = RecordingConnection(connection)
+    channel_id = recorder.fetchval(
+        """SELECT "channel_id" FROM "video" WHERE "stage" = %s GROUP BY "channel_id" ORDER BY count(*) DESC LIMIT 1""",
+        (backend.ProcessingStage.SAVED,),
+    )
+    channel_ids = [channel_id for channel_id, in recorder.fetch("""SELECT "id" FROM "channel" ORDER BY "id" LIMIT 1000""")]
+    calls = [
+        ("select_channels", lambda: inspect.unwrap(backend.select_channels)(db_connection=recorder)),
+        ("select_video", lambda: inspect.unwrap(backend.select_video)(db_connection=recorder)),
+        ("update_channel", lambda: inspect.unwrap(backend.update_channel)(channel_id, db_connection=recorder)),
+        ("select_channel_stats", lambda: inspect.unwrap(scheduler.select_channel_stats)(backend.ProcessingStage.SAVED, channel_ids, db_connection=recorder)),
+        ("api", lambda: recorder.fetch(asgi.api_query(asgi.Emotion.happy, False))),
+    ]
+    for name, call in calls:
+        recorder.statements = []
+        call()
+        yield name, recorder.statements
+
+
+def measure(connection, statements, repeat):
+    results = []
+    connection.autocommit = False
+    try:
+        for query, params in statements:
+            latencies = []
+            with connection.cursor() as cursor:
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    cursor.execute(query, params)
+                    if cursor.description is not None:
+                        cursor.fetchall()
+                    latencies.append((time.perf_counter() - started) * 1000)
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+                plan = cursor.fetchone()[0]
+            latencies.sort()
+            results.append({
+                "query": " ".join(query.split()),
+                "p50_ms": statistics.median(latencies),
+                "p99_ms": latencies[math.ceil(len(latencies) * 0.99) - 1],
+                "plan": plan,
+            })
+    finally:
+        connection.rollback()
+        connection.autocommit = True
+    for result in results:
+        logger.info("p50=%.1fms p99=%.1fms %s", result["p50_ms"], result["p99_ms"], result["query"][:120])
+    return results
+
+
+def compare(baseline, results):
+    for name, statements in results["queries"].items():
+        for index, result in enumerate(statements):
+            try:
+                previous = baseline["queries"][name][index]
+            except (KeyError, IndexError):
+                continue
+            logger.info(
+                "%s[%s]: p50 %.1fms -> %.1fms (x%.2f), p99 %.1fms -> %.1fms (x%.2f)",
+                name, index,
+                previous["p50_ms"], result["p50_ms"], result["p50_ms"] / max(previous["p50_ms"], 1e-9),
+                previous["p99_ms"], result["p99_ms"], result["p99_ms"] / max(previous["p99_ms"], 1e-9),
+            )
+
+
+class RecordingConnection(db.DatabaseConnection):
+    def __init__(self, psycopg2_connection):
+        super().__init__(psycopg2_connection)
+        self.statements = []
+
+    def _execute(self, cursor, query, params, prepare):
+        self.statements.append((query, params))
+        super()._execute(cursor, query, params, prepare)
+
+
+if __name__ == '__main__':
+    logging_config.apply()
+    utils.Error.assert_(db.DSN, "DSN of a scratch database is required")
+    main()
@@ -1,14 +1,22 @@
 import contextlib
 import functools
+import hashlib
+import itertools
 import os
+import re
 import threading
+import time
 
 import psycopg2.extensions
 import psycopg2.extras
 import psycopg2.pool
 
 
-DSN = os.environ["DSN"]
+DSN = os.environ.get("DSN")
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 5))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 5))
+POOL_TIMEOUT = 60
+HEALTH_CHECK_INTERVAL = 30
 
 
 COLUMN_TO_LABEL = {
@@ -35,19 +43,77 @@ def use(fn):
         if db_connection is not None:
             return fn(*args, db_connection=db_connection, **kwargs)
 
-        with use.lock:
-            if not hasattr(use, "pool"):
-                use.pool = psycopg2.pool.SimpleConnectionPool(1, 5, dsn=DSN)
-            connection = use.pool.getconn()
+        pool = get_pool()
+        connection = pool.getconn()
+        broken = False
         try:
             return fn(*args, db_connection=DatabaseConnection(connection), **kwargs)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
         finally:
-            with use.lock:
-                use.pool.putconn(connection)
+            pool.putconn(connection, close=broken)
     return wrapper
 
 
-use.lock = threading.RLock()
+def get_pool():
+    if get_pool.pool is None:
+        with get_pool.lock:
+            if get_pool.pool is None:
+                get_pool.pool = ConnectionPool(DSN, POOL_MIN_SIZE, POOL_MAX_SIZE)
+    return get_pool.pool
+
+
+get_pool.pool = None
+get_pool.lock = threading.Lock()
+
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size, max_size):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min_size, max_size, dsn=dsn, connection_factory=Connection)
+        self._semaphore = threading.BoundedSemaphore(max_size)
+
+    def getconn(self):
+        if not self._semaphore.acquire(timeout=POOL_TIMEOUT):
+            raise psycopg2.pool.PoolError(f"no free connection in pool within {POOL_TIMEOUT} seconds")
+        try:
+            connection = self._pool.getconn()
+            while not self._is_healthy(connection):
+                self._pool.putconn(connection, close=True)
+                connection = self._pool.getconn()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return connection
+
+    def putconn(self, connection, close=False):
+        try:
+            connection.used = time.monotonic()
+            self._pool.putconn(connection, close=close or bool(connection.closed))
+        finally:
+            self._semaphore.release()
+
+    @staticmethod
+    def _is_healthy(connection):
+        if connection.closed:
+            return False
+        if time.monotonic() - connection.used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except psycopg2.Error:
+            return False
+        return True
+
+
+class Connection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.autocommit = True
+        self.used = time.monotonic()
+        self.prepared = set()
+
 
 Undefined = object()
 
@@ -62,9 +128,9 @@ class DatabaseConnection:
         with self._psycopg2_connection:
             yield self
 
-    def execute(self, query, *args, **kwargs):
+    def execute(self, query, params=None, *, prepare=False):
         with self._psycopg2_connection.cursor() as cursor:
-            cursor.execute(query, *args, **kwargs)
+            self._execute(cursor, query, params, prepare)
 
     def executemany(self, query, params_list, page_size=100):
         if len(params_list) > page_size and self._psycopg2_connection.status != psycopg2.extensions.STATUS_IN_TRANSACTION:
@@ -72,14 +138,14 @@ class DatabaseConnection:
         with self._psycopg2_connection.cursor() as cursor:
             psycopg2.extras.execute_batch(cursor, query, params_list, page_size)
 
-    def fetch(self, query, *args, **kwargs):
+    def fetch(self, query, params=None, *, prepare=False):
         with self._psycopg2_connection.cursor() as cursor:
-            cursor.execute(query, *args, **kwargs)
+            self._execute(cursor, query, params, prepare)
             return cursor.fetchall()
 
-    def fetchrow(self, query, *args, **kwargs):
+    def fetchrow(self, query, params=None, *, prepare=False):
         with self._psycopg2_connection.cursor() as cursor:
-            cursor.execute(query, *args, **kwargs)
+            self._execute(cursor, query, params, prepare)
             row = cursor.fetchone()
             if row is None:
                 raise EmptyResult()
@@ -87,9 +153,9 @@ class DatabaseConnection:
                 raise RuntimeError("result has multiple rows")
             return row
 
-    def fetchval(self, query, *args, default=Undefined, **kwargs):
+    def fetchval(self, query, params=None, *, default=Undefined, prepare=False):
         with self._psycopg2_connection.cursor() as cursor:
-            cursor.execute(query, *args, **kwargs)
+            self._execute(cursor, query, params, prepare)
             row = cursor.fetchone()
             if row is None:
                 if default is Undefined:
@@ -101,6 +167,21 @@ class DatabaseConnection:
                 raise RuntimeError("result has multiple columns")
             return row[0]
 
+    def _execute(self, cursor, query, params, prepare):
+        prepared = getattr(self._psycopg2_connection, "prepared", None)
+        if prepare and prepared is not None:
+            name = "youmood_" + hashlib.md5(query.encode()).hexdigest()
+            if name not in prepared:
+                cursor.execute(f"PREPARE {name} AS {to_positional(query)}")
+                prepared.add(name)
+            query = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}"
+        cursor.execute(query, params)
+
+
+def to_positional(query, placeholder_regexp=re.compile("%%|%s")):
+    counter = itertools.count(1)
+    return placeholder_regexp.sub(lambda match: "%" if match[0] == "%%" else f"${next(counter)}", query)
+
 
 class EmptyResult(Exception):
     pass
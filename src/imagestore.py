@@ -0,0 +1,251 @@
+import argparse
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import time
+import zlib
+
+import logging_config
+
+
+logger = logging.getLogger("youmood")
+
+PATH = pathlib.Path(__file__).parent / "images" / "faces.pack"
+MAGIC = b"YMI1"
+HEADER = struct.Struct("<4sHII")
+INDEX_MAGIC = b"YMX1"
+INDEX_HEADER = struct.Struct("<4sQQ")
+INDEX_ENTRY = struct.Struct("<QIIH")
+
+
+def key(channel_id, column):
+    return f"{channel_id}/{column}"
+
+
+def put(key_, data, path=PATH):
+    with locked(path):
+        with open(path, "ab") as file:
+            file.write(pack_record(key_, data))
+
+
+def pack_record(key_, data):
+    key_bytes = key_.encode()
+    return HEADER.pack(MAGIC, len(key_bytes), len(data), zlib.crc32(data)) + key_bytes + data
+
+
+def scan(buffer, offset=0):
+    while offset + HEADER.size <= len(buffer):
+        if not is_record(buffer, offset):
+            next_offset = find_record(buffer, offset + 1)
+            if next_offset < 0:
+                break
+            offset = next_offset
+        _, key_size, data_size, crc = HEADER.unpack_from(buffer, offset)
+        data_offset = offset + HEADER.size + key_size
+        yield offset, bytes(buffer[offset + HEADER.size:data_offset]).decode(), data_offset, data_size, crc
+        offset = data_offset + data_size
+    return offset
+
+
+def find_record(buffer, offset):
+    while True:
+        offset = buffer.find(MAGIC, offset)
+        if offset < 0 or is_record(buffer, offset):
+            return offset
+        offset += 1
+
+
+def is_record(buffer, offset):
+    if offset + HEADER.size > len(buffer):
+        return False
+    magic, key_size, data_size, crc = HEADER.unpack_from(buffer, offset)
+    data_offset = offset + HEADER.size + key_size
+    if magic != MAGIC or data_offset + data_size > len(buffer):
+        return False
+    return zlib.crc32(buffer[data_offset:data_offset + data_size]) == crc
+
+
+def compact(path=PATH):
+    if not path.exists():
+        return
+    with locked(path):
+        with open(path, "rb") as file:
+            data = file.read()
+        key_to_record = {}
+        for _, key_, data_offset, data_size, _ in scan(data):
+            key_to_record[key_] = (data_offset, data_size)
+        tmp_path = path.with_suffix(".tmp")
+        compacted_key_to_record = {}
+        with open(tmp_path, "wb") as file:
+            for key_, (data_offset, data_size) in key_to_record.items():
+                image = data[data_offset:data_offset + data_size]
+                record = pack_record(key_, image)
+                compacted_key_to_record[key_] = (file.tell() + len(record) - data_size, data_size, zlib.crc32(image))
+                file.write(record)
+            file.flush()
+            os.fsync(file.fileno())
+            compacted_size = file.tell()
+            inode = os.fstat(file.fileno()).st_ino
+        write_index(path, inode, compacted_size, compacted_key_to_record)
+        os.replace(tmp_path, path)
+    logger.info("compacted %s from %s to %s bytes", path, len(data), compacted_size)
+
+
+def write_index(path, inode, end, key_to_record):
+    tmp_path = path.with_suffix(".idx.tmp")
+    with open(tmp_path, "wb") as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, inode, end))
+        for key_, (data_offset, data_size, crc) in key_to_record.items():
+            key_bytes = key_.encode()
+            file.write(INDEX_ENTRY.pack(data_offset, data_size, crc, len(key_bytes)) + key_bytes)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path.with_suffix(".idx"))
+
+
+def read_index(path, inode, buffer):
+    try:
+        with open(path.with_suffix(".idx"), "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < INDEX_HEADER.size:
+        return None
+    magic, index_inode, end = INDEX_HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or index_inode != inode or end > len(buffer):
+        return None
+    key_to_record = {}
+    offset = INDEX_HEADER.size
+    while offset < len(data):
+        data_offset, data_size, crc, key_size = INDEX_ENTRY.unpack_from(data, offset)
+        offset += INDEX_ENTRY.size
+        key_ = data[offset:offset + key_size].decode()
+        offset += key_size
+        record_offset = data_offset - HEADER.size - key_size
+        if data_offset + data_size > end or HEADER.unpack_from(buffer, record_offset)[0] != MAGIC:
+            return None
+        key_to_record[key_] = (data_offset, data_size, crc)
+    return end, key_to_record
+
+
+def compact_periodically(interval=24 * 3600, garbage_ratio_min=0.5, path=PATH):
+    while True:
+        time.sleep(interval)
+        try:
+            reader = PackReader(path)
+            num_keys = len(reader.key_to_record)
+            num_records = reader.num_records
+            reader.close()
+            if num_records and 1 - num_keys / num_records >= garbage_ratio_min:
+                compact(path)
+        except Exception as error:
+            logger.exception("error when compacting %s: %s", path, error)
+
+
+def import_directory(directory, path=PATH):
+    reader = PackReader(path)
+    existing_keys = set(reader.key_to_record)
+    reader.close()
+    num_images = 0
+    for filepath in sorted(directory.glob("*/*.jpg")):
+        key_ = key(filepath.parent.name, filepath.stem)
+        if key_ not in existing_keys:
+            put(key_, filepath.read_bytes(), path)
+            num_images += 1
+    logger.info("imported %s images from %s to %s", num_images, directory, path)
+    compact(path)
+
+
+@contextlib.contextmanager
+def locked(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".lock"), "ab") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class PackReader:
+    def __init__(self, path=PATH, refresh_interval=1.0):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.key_to_record = {}
+        self.num_records = 0
+        self._file = None
+        self._mmap = None
+        self._scanned = 0
+        self._refreshed = float("-inf")
+        self.refresh()
+
+    def get(self, key_):
+        if time.monotonic() - self._refreshed >= self.refresh_interval:
+            self.refresh()
+        try:
+            data_offset, data_size, crc = self.key_to_record[key_]
+        except KeyError:
+            return None
+        return self._mmap[data_offset:data_offset + data_size], crc
+
+    def refresh(self):
+        self._refreshed = time.monotonic()
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if self._file is None or os.fstat(self._file.fileno()).st_ino != stat.st_ino:
+            self.close()
+            self._file = open(self.path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size > (len(self._mmap) if self._mmap is not None else 0):
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+            if not self._scanned:
+                index = read_index(self.path, os.fstat(self._file.fileno()).st_ino, self._mmap)
+                if index is not None:
+                    self._scanned, self.key_to_record = index
+                    self.num_records = len(self.key_to_record)
+            records = scan(self._mmap, self._scanned)
+            while True:
+                try:
+                    _, key_, data_offset, data_size, crc = next(records)
+                except StopIteration as stop:
+                    self._scanned = stop.value
+                    break
+                self.key_to_record[key_] = (data_offset, data_size, crc)
+                self.num_records += 1
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+        self.key_to_record = {}
+        self.num_records = 0
+        self._file = None
+        self._mmap = None
+        self._scanned = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="manage the packed face image store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="import <channel_id>/<emotion>.jpg files from directory")
+    import_parser.add_argument("directory", type=pathlib.Path, nargs="?", default=PATH.parent)
+    subparsers.add_parser("compact", help="drop overwritten images from the pack")
+    args = parser.parse_args()
+    if args.command == "import":
+        import_directory(args.directory)
+    else:
+        compact()
+
+
+if __name__ == '__main__':
+    logging_config.apply()
+    main()
@@ -1,9 +1,12 @@
+import functools
 import io
 import itertools
 import json
 import logging
+import math
 import os
 import pathlib
+import random
 import re
 import signal
 import socket
@@ -22,22 +25,32 @@ from hsemotion.facial_emotions import HSEmotionRecognizer
 from PIL import Image
 
 import db
+import imagestore
 import logging_config
 import pytube_patch
+import scheduler
 import utils
 
 
 logger = logging.getLogger("youmood")
 
-GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 PROCESSING_INTERVAL = timedelta(days=7)
 SYNC_INTERVAL = timedelta(days=1)
+SAMPLING_INTERVAL_MIN = 0.5
+SAMPLING_INTERVAL_MAX = 4.0
+SAMPLING_SCORE_MIN = 0.5
+SAMPLING_SCORE_DELTA_MAX = 0.15
+EARLY_STOP_TOLERANCE = float(os.environ.get("EARLY_STOP_TOLERANCE", 0))
+EARLY_STOP_SAMPLES_MIN = 60
+SCHEDULER = scheduler.Scheduler(PROCESSING_INTERVAL)
 
 pytube_patch.init()
 
 
 def main():
     utils.start_thread(synchronize_channels)
+    utils.start_thread(imagestore.compact_periodically)
     while True:
         video = get_video()
         if video:
@@ -53,7 +66,10 @@ def main():
 
 def migrate():
     backend = yoyo.get_backend(db.DSN)
-    migrations = yoyo.read_migrations(str(pathlib.Path(__file__).parent / "migrations"))
+    directory = pathlib.Path(__file__).parent / "migrations"
+    if not directory.exists():
+        directory = pathlib.Path(__file__).parent.parent / "migrations"
+    migrations = yoyo.read_migrations(str(directory))
     with backend.lock():
         backend.apply_migrations(backend.to_apply(migrations))
 
@@ -84,9 +100,11 @@ def get_video():
 
 
 def analyze_video(video):
+    if EARLY_STOP_TOLERANCE > 0:
+        return analyze_video_early_stop(video, EARLY_STOP_TOLERANCE)
     label_to_max_score = defaultdict(float)
-    face_detector = RMN()
-    analyzer = HSEmotionRecognizer()
+    face_detector, analyzer = load_models()
+    sampler = AdaptiveSampler(video["fps"])
     results = []
     logger.info("fps: %s", video["fps"])
     frames = iio.imiter(video["buffer"], extension=".mp4")
@@ -94,11 +112,12 @@ def analyze_video(video):
     if frame.shape[0] > frame.shape[1]:
         raise utils.Error("it seems to be short")
     frame_index = 0
+    minutes = 0
     for frame in itertools.chain([frame], frames):
-        if frame_index % video["fps"] == 0:
-            seconds = frame_index // video["fps"]
-            if seconds % 60 == 0:
-                logger.info("processed %s minutes for video(%s)", seconds // 60, video["id"])
+        if frame_index == sampler.next_frame_index:
+            if frame_index // (60 * video["fps"]) >= minutes:
+                logger.info("processed %s minutes for video(%s)", minutes, video["id"])
+                minutes += 1
             face_image = face_detector.find_face(frame)
             if face_image is not None:
                 label, scores = analyzer.predict_emotions(face_image, False)
@@ -106,49 +125,112 @@ def analyze_video(video):
                 if score >= label_to_max_score[label]:
                     label_to_max_score[label] = score
                     save_face(video["channel_id"], label, face_image)
-                results.append(label)
+                results.append([label, sampler.update(frame_index, label, score)])
+                result_frame_index = frame_index
+            else:
+                sampler.update(frame_index)
         frame_index += 1
-    logger.info("analyzed video(%s): %s", video["id"], video["title"])
-    return results, {**video, "num_frames": frame_index + 1}
+    if results:
+        results[-1][1] = min(results[-1][1], (frame_index - result_frame_index) / video["fps"])
+    duration = frame_index / video["fps"]
+    logger.info(
+        "analyzed video(%s): %s, average sampling interval %.2f seconds",
+        video["id"], video["title"], duration / max(sampler.num_samples, 1),
+    )
+    return results, {**video, "num_frames": frame_index + 1, "num_samples": sampler.num_samples, "sampled_duration": duration}
+
+
+def analyze_video_early_stop(video, tolerance):
+    label_to_max_score = defaultdict(float)
+    face_detector, analyzer = load_models()
+    logger.info("fps: %s", video["fps"])
+    with iio.imopen(video["buffer"], "r", extension=".mp4") as file:
+        reader = file.legacy_get_reader()
+        try:
+            frame = reader.get_data(0)
+            if frame.shape[0] > frame.shape[1]:
+                raise utils.Error("it seems to be short")
+            fps = reader.get_meta_data()["fps"]
+            num_frames = reader.count_frames()
+            duration = num_frames / fps
+            sampler = EarlyStopSampler(max(int(duration), 1), tolerance)
+            for seconds in sampler:
+                frame = reader.get_data(min(round(seconds * fps), num_frames - 1))
+                face_image = face_detector.find_face(frame)
+                label = None
+                if face_image is not None:
+                    label, scores = analyzer.predict_emotions(face_image, False)
+                    score = scores.max().item()
+                    if score >= label_to_max_score[label]:
+                        label_to_max_score[label] = score
+                        save_face(video["channel_id"], label, face_image)
+                sampler.update(label)
+        finally:
+            reader.close()
+    seconds_per_sample = sampler.num_seconds / sampler.num_samples
+    results = [[label, seconds_per_sample] for label in sampler.labels if label is not None]
+    logger.info(
+        "analyzed video(%s): %s, stopped after %s of %s seconds",
+        video["id"], video["title"], sampler.num_samples, sampler.num_seconds,
+    )
+    return results, {
+        **video,
+        "num_frames": round(duration * video["fps"]),
+        "num_samples": sampler.num_samples,
+        "sampled_duration": float(sampler.num_seconds),
+    }
 
 
 @utils.retry(1, 3, 10, 30, 60)
 @db.use
 def save(video, results, *, db_connection):
     video_id = video["id"]
-    label_to_num_frames = defaultdict(int)
     if results:
-        for label in results:
-            label_to_num_frames[label] += 1
         with db_connection.transaction():
-            db_connection.execute(
-                """
-                UPDATE "video" SET
-                "fps"=%s, "num_frames"=%s,
-                "angry"=%s, "disgust"=%s, "fear"=%s, "happy"=%s, "neutral"=%s, "sad"=%s, "surprise"=%s, "contempt"=%s
-                WHERE "id" = %s
-                """,
-                (
-                    video["fps"],
-                    video["num_frames"],
-                    label_to_num_frames["Anger"],
-                    label_to_num_frames["Disgust"],
-                    label_to_num_frames["Fear"],
-                    label_to_num_frames["Happiness"],
-                    label_to_num_frames["Neutral"],
-                    label_to_num_frames["Sadness"],
-                    label_to_num_frames["Surprise"],
-                    label_to_num_frames["Contempt"],
-                    video_id
-                ),
-            )
-            set_video_stage(video_id, ProcessingStage.SAVED, db_connection=db_connection)
+            update_videos([(video, results)], db_connection=db_connection)
         update_channel(video["channel_id"], db_connection=db_connection)
         logger.info("saved data for video(%s)", video_id)
     else:
         set_video_stage(video_id, -ProcessingStage.SAVED, db_connection=db_connection)
 
 
+@db.use
+def update_videos(videos_results, *, db_connection):
+    query = """
+        UPDATE "video" SET
+        "stage"=%s, "fps"=%s, "num_frames"=%s, "num_samples"=%s, "sampled_duration"=%s,
+        "angry"=%s, "disgust"=%s, "fear"=%s, "happy"=%s, "neutral"=%s, "sad"=%s, "surprise"=%s, "contempt"=%s
+        WHERE "id" = %s
+    """
+    params_list = []
+    for video, results in videos_results:
+        column_to_seconds = count_seconds(results)
+        params_list.append((
+            ProcessingStage.SAVED,
+            video["fps"],
+            video["num_frames"],
+            video["num_samples"],
+            video["sampled_duration"],
+            column_to_seconds["angry"],
+            column_to_seconds["disgust"],
+            column_to_seconds["fear"],
+            column_to_seconds["happy"],
+            column_to_seconds["neutral"],
+            column_to_seconds["sad"],
+            column_to_seconds["surprise"],
+            column_to_seconds["contempt"],
+            video["id"],
+        ))
+    db_connection.executemany(query, params_list)
+
+
+def count_seconds(results):
+    label_to_seconds = defaultdict(float)
+    for label, seconds in results:
+        label_to_seconds[label] += seconds
+    return {column: round(label_to_seconds[label]) for column, label in db.COLUMN_TO_LABEL.items()}
+
+
 @utils.retry(1, 3, 10, 30, 60, repeat_last=True)
 @utils.rate_limit(bucket_time=60)
 @db.use
@@ -165,17 +247,19 @@ def select_channels(*, db_connection):
         LEFT JOIN "last_processed_video" ON "last_processed_video"."channel_id" = "channel"."id"
         WHERE coalesce("last_processed_video"."published", '1970-01-01T00:00Z'::timestamptz) < %s
           AND coalesce("channel"."synchronized", '1970-01-01T00:00Z'::timestamptz) < %s
-        ORDER BY "channel"."synchronized" NULLS FIRST, "channel"."id"
+        ORDER BY "channel"."id"
     """
     now = utils.now()
-    rows = db_connection.fetch(query, (ProcessingStage.SAVED, now - PROCESSING_INTERVAL, now - SYNC_INTERVAL))
-    logger.info("selected %s channels to synchronize", len(rows))
-    return [channel_id for channel_id, in rows]
+    rows = db_connection.fetch(query, (ProcessingStage.SAVED, now - PROCESSING_INTERVAL, now - SYNC_INTERVAL), prepare=True)
+    channel_id_to_stats = scheduler.select_channel_stats(ProcessingStage.SAVED, [channel_id for channel_id, in rows], db_connection=db_connection)
+    channel_ids = SCHEDULER.rank_channels([channel_id_to_stats[channel_id] for channel_id, in rows], now)
+    logger.info("selected %s of %s channels to synchronize", len(channel_ids), len(rows))
+    return channel_ids
 
 
 @utils.cached(SYNC_INTERVAL.total_seconds())
 @utils.retry(1, 3, 10, 30, 60)
-@utils.rate_limit(bucket_time=timedelta(hours=24).total_seconds(), bucket_size=110)
+@utils.rate_limit(bucket_time=timedelta(hours=24).total_seconds(), bucket_size=scheduler.QUOTA_PER_DAY)
 @utils.rate_limit(bucket_time=60)
 @db.use
 def synchronize_channel(
@@ -187,6 +271,7 @@ def synchronize_channel(
 ):
     url = url_pattern.format(channel_id, num_video_max)
     request = urllib.request.Request(url, headers={"X-goog-api-key": GOOGLE_API_KEY})
+    SCHEDULER.record_sync(utils.now())
     response = urllib.request.urlopen(request)
     utils.Error.assert_(response.status == 200, f"expected status 200 instead of {response.status}")
     data = response.read()
@@ -237,17 +322,19 @@ def select_video(video_age_max=timedelta(days=30), *, db_connection):
         WHERE %s < "last_video"."published"
           AND coalesce("last_processed_video"."published", '1970-01-01T00:00Z'::timestamptz) < %s
         ORDER BY "last_processed_video"."published" NULLS FIRST
-        LIMIT 1
     """
     now = utils.now()
     params = (ProcessingStage.SAVED, ProcessingStage.SAVED, now - video_age_max, now - PROCESSING_INTERVAL)
-    try:
-        id_, title, channel_id = db_connection.fetchrow(query, params)
-    except db.EmptyResult:
+    videos = [
+        {"id": id_, "title": title, "channel_id": channel_id}
+        for id_, title, channel_id in db_connection.fetch(query, params, prepare=True)
+    ]
+    if not videos:
         return None
-    else:
-        logger.info("selected video(%s): %s", id_, title or "")
-        return {"id": id_, "title": title, "channel_id": channel_id}
+    channel_id_to_stats = scheduler.select_channel_stats(ProcessingStage.SAVED, [video["channel_id"] for video in videos], db_connection=db_connection)
+    video = SCHEDULER.rank_videos(videos, channel_id_to_stats, now)[0]
+    logger.info("selected video(%s): %s", video["id"], video["title"] or "")
+    return video
 
 
 @utils.retry(1, 3, 10, 30, 60, bypass=(pytube.exceptions.VideoUnavailable,))
@@ -282,7 +369,7 @@ def download_video(video, url_pattern="https://www.youtube.com/watch?v={}"):
 @db.use
 def set_video_stage(video_id, stage, *, db_connection):
     query = """UPDATE "video" SET "stage" = %s WHERE "id" = %s"""
-    db_connection.execute(query, (stage, video_id))
+    db_connection.execute(query, (stage, video_id), prepare=True)
 
 
 @utils.retry(1, 3, 10, 30, 60, repeat_last=True)
@@ -305,6 +392,7 @@ def update_channel(channel_id, *, db_connection):
             AND "fear" IS NOT NULL AND "disgust" IS NOT NULL AND "neutral" IS NOT NULL AND "contempt" IS NOT NULL
         """,
         (channel_id, utils.now() - timedelta(days=30)),
+        prepare=True,
     )
     if rows:
         db_connection.execute(
@@ -314,6 +402,7 @@ def update_channel(channel_id, *, db_connection):
             WHERE "id"=%s
             """,
             (*rows[0], channel_id),
+            prepare=True,
         )
         logger.info("updated channel %s", channel_id)
 
@@ -333,6 +422,78 @@ class ProcessingStage:
     SAVED = 3
 
 
+class AdaptiveSampler:
+    def __init__(self, fps, interval_min=SAMPLING_INTERVAL_MIN, interval_max=SAMPLING_INTERVAL_MAX):
+        self.fps = fps
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.interval = 1.0
+        self.next_frame_index = 0
+        self.num_samples = 0
+        self._label = None
+        self._score = None
+
+    def update(self, frame_index, label=None, score=None):
+        if label is None:
+            self.interval = 1.0
+        elif score < SAMPLING_SCORE_MIN:
+            self.interval = self.interval_min
+        elif label == self._label and abs(score - self._score) <= SAMPLING_SCORE_DELTA_MAX:
+            self.interval = min(self.interval + 1, self.interval_max)
+        else:
+            self.interval = 1.0
+        self._label, self._score = label, score
+        step = max(round(self.interval * self.fps), 1)
+        self.next_frame_index = frame_index + step
+        self.num_samples += 1
+        return step / self.fps
+
+
+class EarlyStopSampler:
+    def __init__(self, num_seconds, tolerance, num_samples_min=EARLY_STOP_SAMPLES_MIN, batch_size=30, z=1.96):
+        self.num_seconds = num_seconds
+        self.tolerance = tolerance
+        self.num_samples_min = num_samples_min
+        self.batch_size = batch_size
+        self.z = z
+        self.labels = []
+
+    @property
+    def num_samples(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        order = random.sample(range(self.num_seconds), self.num_seconds)
+        for start in range(0, self.num_seconds, self.batch_size):
+            if self.converged():
+                return
+            yield from order[start:start + self.batch_size]
+
+    def update(self, label):
+        self.labels.append(label)
+
+    def converged(self):
+        n = self.num_samples
+        if n < self.num_samples_min:
+            return False
+        if n >= self.num_seconds:
+            return True
+        label_to_count = defaultdict(int)
+        for label in self.labels:
+            label_to_count[label] += 1
+        finite_population_correction = math.sqrt((self.num_seconds - n) / (self.num_seconds - 1))
+        for label in (None, *db.LABEL_TO_COLUMN):
+            p = (label_to_count[label] + 1) / (n + 2)
+            if self.z * math.sqrt(p * (1 - p) / n) * finite_population_correction > self.tolerance:
+                return False
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def load_models():
+    return RMN(), HSEmotionRecognizer()
+
+
 class RMN(rmn.RMN):
     @torch.no_grad()
     def find_face(self, frame):
@@ -346,10 +507,9 @@ class RMN(rmn.RMN):
 
 
 def save_face(channel_id, label, image):
-    column = db.LABEL_TO_COLUMN[label]
-    filepath = pathlib.Path(__file__).parent / "images" / channel_id / (column + ".jpg")
-    filepath.parent.mkdir(parents=True, exist_ok=True)
-    Image.fromarray(image).save(filepath)
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="JPEG")
+    imagestore.put(imagestore.key(channel_id, db.LABEL_TO_COLUMN[label]), buffer.getvalue())
     logger.info("saved %s face for channel-id=%s", label, channel_id)
 
 
@@ -360,7 +520,10 @@ if __name__ == '__main__':
     socket.setdefaulttimeout(600)
     db.register_dict_as_json()
     try:
+        utils.Error.assert_(GOOGLE_API_KEY, "GOOGLE_API_KEY is required")
+        utils.Error.assert_(db.DSN, "DSN is required")
         migrate()
+        db.get_pool()
         main()
     except Exception as _error:
         logger.exception("unexpected error: %s", _error)
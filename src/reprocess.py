@@ -0,0 +1,172 @@
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import signal
+import time
+
+import imageio.v3 as iio
+import torch
+
+import db
+import logging_config
+import main as backend
+import utils
+
+
+logger = logging.getLogger("youmood")
+
+CSV_COLUMNS = ["id", "channel_id", "fps", "num_frames", "num_samples", "sampled_duration", *db.COLUMN_TO_LABEL]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="analyze local mp4 files with the backend pipeline")
+    parser.add_argument("source", help="directory of <channel_id>/<video_id>.mp4 files or CSV manifest with path,id,channel_id columns")
+    parser.add_argument("--output", help="CSV file to append results to instead of updating the database")
+    parser.add_argument("--progress", default="reprocess.progress", help="file with processed video ids, used to resume")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+    utils.Error.assert_(args.output or db.DSN, "DSN is required unless --output is given")
+
+    done = read_progress(args.progress)
+    videos = [video for video in list_videos(pathlib.Path(args.source)) if video["id"] not in done]
+    logger.info("%s videos to process, %s already processed", len(videos), len(done))
+    throughput = Throughput()
+    batch = []
+    with multiprocessing.Pool(args.processes, initializer=init_worker) as pool, open(args.progress, "a") as progress:
+        for video, results in pool.imap_unordered(process, videos):
+            batch.append((video, results))
+            throughput.add(video)
+            if len(batch) >= args.batch_size:
+                write(batch, args.output, progress)
+                batch = []
+                throughput.report()
+        write(batch, args.output, progress)
+        throughput.report()
+
+
+def list_videos(source):
+    if source.is_dir():
+        return [
+            {"id": path.stem, "channel_id": path.parent.name, "title": path.name, "path": str(path)}
+            for path in sorted(source.rglob("*.mp4"))
+        ]
+    with source.open(newline="") as file:
+        return [
+            {
+                "id": row.get("id") or pathlib.Path(row["path"]).stem,
+                "channel_id": row["channel_id"],
+                "title": row.get("title") or pathlib.Path(row["path"]).name,
+                "path": str(source.parent / row["path"]),
+            }
+            for row in csv.DictReader(file)
+        ]
+
+
+def read_progress(filepath):
+    try:
+        with open(filepath) as file:
+            id_to_status = {}
+            for line in file:
+                if line.strip():
+                    item = json.loads(line)
+                    id_to_status[item["id"]] = item["status"]
+            return {id_ for id_, status in id_to_status.items() if status in ("ok", "missing")}
+    except FileNotFoundError:
+        return set()
+
+
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch.set_num_threads(1)
+    backend.load_models()
+
+
+def process(video):
+    try:
+        fps = round(iio.immeta(video["path"], extension=".mp4")["fps"])
+        results, video = backend.analyze_video({**video, "fps": fps, "buffer": video["path"]})
+    except Exception as error:
+        logger.error("error when analyzing video(%s) %s: %s", video["id"], video["path"], error, exc_info=not isinstance(error, utils.Error))
+        return video, None
+    del video["buffer"]
+    return video, results
+
+
+def write(batch, output, progress):
+    missing_ids = set()
+    if output:
+        write_csv(batch, output)
+    else:
+        missing_ids = save_batch(batch)
+    for video, results in batch:
+        if video["id"] in missing_ids:
+            status = "missing"
+        elif results is None:
+            status = "failed"
+        else:
+            status = "ok"
+        progress.write(json.dumps({"id": video["id"], "status": status}) + "\n")
+    progress.flush()
+    os.fsync(progress.fileno())
+
+
+def write_csv(batch, filepath):
+    is_new = not os.path.exists(filepath)
+    with open(filepath, "a", newline="") as file:
+        writer = csv.DictWriter(file, CSV_COLUMNS, extrasaction="ignore")
+        if is_new:
+            writer.writeheader()
+        for video, results in batch:
+            if results:
+                writer.writerow({**video, **backend.count_seconds(results)})
+
+
+@utils.retry(1, 3, 10, 30, 60)
+@db.use
+def save_batch(batch, *, db_connection):
+    ids = tuple(video["id"] for video, results in batch if results is not None)
+    existing_ids = {id_ for id_, in db_connection.fetch("""SELECT "id" FROM "video" WHERE "id" IN %s""", (ids,))} if ids else set()
+    missing_ids = set(ids) - existing_ids
+    if missing_ids:
+        logger.warning("skipped %s videos missing in the video table: %s", len(missing_ids), ", ".join(sorted(missing_ids)))
+    batch = [(video, results) for video, results in batch if video["id"] in existing_ids]
+    with db_connection.transaction():
+        backend.update_videos([(video, results) for video, results in batch if results], db_connection=db_connection)
+        for video, results in batch:
+            if not results:
+                backend.set_video_stage(video["id"], -backend.ProcessingStage.SAVED, db_connection=db_connection)
+    for channel_id in sorted({video["channel_id"] for video, results in batch if results}):
+        backend.update_channel(channel_id, db_connection=db_connection)
+    logger.info("saved data for %s videos", len(batch))
+    return missing_ids
+
+
+class Throughput:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.num_videos = 0
+        self.num_frames = 0
+        self.num_samples = 0
+
+    def add(self, video):
+        self.num_videos += 1
+        self.num_frames += video.get("num_frames") or 0
+        self.num_samples += video.get("num_samples") or 0
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        logger.info(
+            "processed %s videos: %.1f videos/hour, %.1f frames/sec, %.1f samples/sec",
+            self.num_videos, self.num_videos * 3600 / elapsed, self.num_frames / elapsed, self.num_samples / elapsed,
+        )
+
+
+if __name__ == '__main__':
+    logging_config.apply()
+    db.register_dict_as_json()
+    main()
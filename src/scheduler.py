@@ -0,0 +1,232 @@
+import argparse
+import collections
+import logging
+import threading
+from collections import defaultdict, deque
+from datetime import timedelta
+
+import db
+import logging_config
+import utils
+
+
+logger = logging.getLogger("youmood")
+
+EPOCH = utils.fromtimestamp(0)
+QUOTA_PER_DAY = 110
+STARVATION_INTERVAL = timedelta(days=7)
+UPLOAD_RATE_WINDOW = timedelta(days=30)
+VIDEO_AGE_MAX = timedelta(days=30)
+VIDEO_DURATION_DEFAULT = 600.0
+NUM_VIDEOS_PRIOR = 0.1
+STALENESS_MAX = 4.0
+
+ChannelStats = collections.namedtuple(
+    "ChannelStats",
+    ["id", "synchronized", "num_recent_videos", "avg_duration", "num_failed", "num_attempted", "last_processed"],
+)
+
+
+class Scheduler:
+    def __init__(self, processing_interval, quota_per_day=QUOTA_PER_DAY, starvation_interval=STARVATION_INTERVAL):
+        self.processing_interval = processing_interval
+        self.quota_per_day = quota_per_day
+        self.starvation_interval = starvation_interval
+        self._lock = threading.Lock()
+        self._syncs = deque()
+
+    def record_sync(self, now):
+        with self._lock:
+            self._syncs.append(now)
+
+    def remaining_quota(self, now):
+        with self._lock:
+            while self._syncs and self._syncs[0] <= now - timedelta(days=1):
+                self._syncs.popleft()
+            return self.quota_per_day - len(self._syncs)
+
+    def rank_channels(self, stats_list, now):
+        stats_list = sorted(stats_list, key=lambda stats: self.sync_priority(stats, now), reverse=True)
+        return [stats.id for stats in stats_list[:max(self.remaining_quota(now), 0)]]
+
+    def rank_videos(self, videos, channel_id_to_stats, now):
+        return sorted(videos, key=lambda video: self.video_priority(channel_id_to_stats[video["channel_id"]], now), reverse=True)
+
+    def sync_priority(self, stats, now):
+        waited = now - (stats.synchronized or EPOCH)
+        if waited >= self.starvation_interval:
+            return 1, waited.total_seconds()
+        num_expected_videos = upload_rate(stats) * waited.total_seconds() / 86400 + NUM_VIDEOS_PRIOR
+        return 0, num_expected_videos * (1 - failure_rate(stats))
+
+    def video_priority(self, stats, now):
+        staleness = now - (stats.last_processed or EPOCH)
+        if staleness >= self.processing_interval + self.starvation_interval:
+            return 1, staleness.total_seconds()
+        value = (1 - failure_rate(stats)) * min(staleness / self.processing_interval, STALENESS_MAX)
+        return 0, value / (stats.avg_duration or VIDEO_DURATION_DEFAULT)
+
+
+class SqlOrderScheduler(Scheduler):
+    def sync_priority(self, stats, now):
+        return -(stats.synchronized or EPOCH).timestamp()
+
+    def video_priority(self, stats, now):
+        return -(stats.last_processed or EPOCH).timestamp()
+
+
+POLICIES = {"sql": SqlOrderScheduler, "value": Scheduler}
+
+
+def upload_rate(stats):
+    return stats.num_recent_videos / (UPLOAD_RATE_WINDOW.total_seconds() / 86400)
+
+
+def failure_rate(stats):
+    return (stats.num_failed + 1) / (stats.num_attempted + 2)
+
+
+@utils.retry(1, 3, 10, 30, 60, repeat_last=True)
+@db.use
+def select_channel_stats(saved_stage, channel_ids, *, db_connection):
+    if not channel_ids:
+        return {}
+    query = """
+        SELECT
+            "channel"."id",
+            "channel"."synchronized",
+            count("video"."id") FILTER (WHERE "video"."published" > %s),
+            avg("video"."num_frames"::real / "video"."fps") FILTER (WHERE "video"."fps" > 0),
+            count("video"."id") FILTER (WHERE "video"."stage" < 0),
+            count("video"."id") FILTER (WHERE "video"."stage" <> 0),
+            max("video"."published") FILTER (WHERE "video"."stage" = %s)
+        FROM "channel"
+        LEFT JOIN "video" ON "video"."channel_id" = "channel"."id"
+        WHERE "channel"."id" IN %s
+        GROUP BY "channel"."id"
+    """
+    rows = db_connection.fetch(query, (utils.now() - UPLOAD_RATE_WINDOW, saved_stage, tuple(channel_ids)))
+    return {row[0]: ChannelStats(*row) for row in rows}
+
+
+@db.use
+def select_history(*, db_connection):
+    query = """
+        SELECT "id", "channel_id", "published", "stage", "num_frames"::real / nullif("fps", 0)
+        FROM "video"
+        ORDER BY "published"
+    """
+    return [
+        {"id": id_, "channel_id": channel_id, "published": published, "stage": stage, "duration": duration}
+        for id_, channel_id, published, stage, duration in db_connection.fetch(query)
+    ]
+
+
+def simulate(policy, videos, days, cpu_hours_per_day, sync_interval, processing_interval, step=timedelta(hours=1)):
+    scheduler = POLICIES[policy](processing_interval)
+    end = max(video["published"] for video in videos)
+    now = end - timedelta(days=days)
+    channel_ids = sorted({video["channel_id"] for video in videos})
+    channel_id_to_videos = defaultdict(list)
+    for video in videos:
+        channel_id_to_videos[video["channel_id"]].append(video)
+    synchronized = {}
+    known = defaultdict(list)
+    attempted = set()
+    durations = defaultdict(list)
+    num_failed = defaultdict(int)
+    last_processed = {}
+    last_analyzed = dict.fromkeys(channel_ids, now)
+    cpu_budget = 0.0
+    num_analyzed = 0
+    num_failed_total = 0
+    latencies = []
+
+    def channel_stats(channel_id):
+        recent = [v for v in known[channel_id] if v["published"] > now - UPLOAD_RATE_WINDOW]
+        channel_durations = durations[channel_id]
+        return ChannelStats(
+            channel_id,
+            synchronized.get(channel_id),
+            len(recent),
+            sum(channel_durations) / len(channel_durations) if channel_durations else None,
+            num_failed[channel_id],
+            sum(1 for v in known[channel_id] if v["id"] in attempted),
+            last_processed.get(channel_id),
+        )
+
+    while now < end:
+        now += step
+        cpu_budget = min(cpu_budget, 0.0) + cpu_hours_per_day * 3600 * (step / timedelta(days=1))
+        id_to_stats = {channel_id: channel_stats(channel_id) for channel_id in channel_ids}
+        due = [
+            stats for stats in id_to_stats.values()
+            if (stats.synchronized or EPOCH) < now - sync_interval
+            and (stats.last_processed or EPOCH) < now - processing_interval
+        ]
+        for channel_id in scheduler.rank_channels(due, now):
+            scheduler.record_sync(now)
+            synchronized[channel_id] = now
+            known[channel_id] = [v for v in channel_id_to_videos[channel_id] if v["published"] <= now]
+        while cpu_budget > 0:
+            candidates = []
+            for channel_id in channel_ids:
+                if last_processed.get(channel_id, EPOCH) >= now - processing_interval:
+                    continue
+                for video in reversed(known[channel_id]):
+                    if video["id"] not in attempted:
+                        if video["published"] > now - VIDEO_AGE_MAX:
+                            candidates.append(video)
+                        break
+            if not candidates:
+                break
+            video = scheduler.rank_videos(candidates, {c["channel_id"]: channel_stats(c["channel_id"]) for c in candidates}, now)[0]
+            attempted.add(video["id"])
+            cpu_budget -= video["duration"] or VIDEO_DURATION_DEFAULT
+            if video["stage"] < 0:
+                num_failed[video["channel_id"]] += 1
+                num_failed_total += 1
+            else:
+                last_analyzed[video["channel_id"]] = now
+                last_processed[video["channel_id"]] = video["published"]
+                durations[video["channel_id"]].append(video["duration"] or VIDEO_DURATION_DEFAULT)
+                latencies.append((now - video["published"]).total_seconds() / 3600)
+                num_analyzed += 1
+    latencies.sort()
+    staleness_max = max(end - analyzed for analyzed in last_analyzed.values())
+    return {
+        "policy": policy,
+        "num_analyzed": num_analyzed,
+        "num_failed": num_failed_total,
+        "num_channels_covered": len(last_processed),
+        "latency_hours_p50": latencies[len(latencies) // 2] if latencies else None,
+        "latency_hours_p99": latencies[int(len(latencies) * 0.99)] if latencies else None,
+        "staleness_days_max": staleness_max.total_seconds() / 86400,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay the video table to compare scheduling policies offline")
+    parser.add_argument("--policy", nargs="+", choices=sorted(POLICIES), default=sorted(POLICIES))
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--cpu-hours-per-day", type=float, default=24.0)
+    parser.add_argument("--sync-interval-days", type=float, default=1.0)
+    parser.add_argument("--processing-interval-days", type=float, default=7.0)
+    args = parser.parse_args()
+    videos = select_history()
+    utils.Error.assert_(videos, "video table is empty")
+    for policy in args.policy:
+        result = simulate(
+            policy,
+            videos,
+            args.days,
+            args.cpu_hours_per_day,
+            timedelta(days=args.sync_interval_days),
+            timedelta(days=args.processing_interval_days),
+        )
+        logger.info("simulated %s", result)
+
+
+if __name__ == '__main__':
+    logging_config.apply()
+    main()
@@ -71,6 +71,7 @@ def cached(timeout):
     def decorator(fn):
         cache = {}
 
+        @functools.wraps(fn)
         def wrapper(*args, **kwargs):
             key = args + tuple(sorted(kwargs.items(), key=lambda pair: pair[0]))
             try: